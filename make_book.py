@@ -1,246 +1,498 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import json
 import os
 import sys
-import urllib.request
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import lxml.etree
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+from html import escape
+from requests.adapters import HTTPAdapter
+from urllib.parse import unquote, urljoin, urlparse
 
+# Maximum number of chapters downloaded at the same time
+CONCURRENT_DOWNLOADS = 8
 
+# Maximum number of resources (images, stylesheets, scripts) downloaded at the same time
+RESOURCE_DOWNLOAD_WORKERS = 16
+
+# Size in bytes of the chunks in which resources are written to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Timeout in seconds for HTTP requests
+REQUEST_TIMEOUT = 10
+
+# Shared session so that all requests to projekt-gutenberg.org reuse pooled connections
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=RESOURCE_DOWNLOAD_WORKERS))
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=RESOURCE_DOWNLOAD_WORKERS))
+
+# Directory for downloaded pages, which are revalidated with the server instead of being downloaded again
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'gutenberg_to_epub')
+
+
+def _cache_paths(url):
+    """
+    Returns the paths of the cached content and of its validators for a URL.
+
+    Parameters:
+    url (str): The URL of the web page.
+
+    Returns:
+    tuple: The path of the cached content and the path of the JSON file with the validators.
+    """
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.html"), os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def _read_cache(url):
+    """
+    Reads a web page from the disk cache.
+
+    Parameters:
+    url (str): The URL of the web page.
+
+    Returns:
+    tuple: The cached content as bytes and the headers for a conditional request,
+           or None and empty headers if the page is not cached.
+    """
+    content_path, validators_path = _cache_paths(url)
+    try:
+        with open(validators_path, encoding='utf-8') as file:
+            validators = json.load(file)
+        with open(content_path, 'rb') as file:
+            content = file.read()
+    except (OSError, ValueError):
+        return None, {}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return content, headers
+
+
+def _write_cache(url, content, headers):
+    """
+    Writes a web page to the disk cache if the server sent validators (ETag or Last-Modified) for it.
+
+    Parameters:
+    url (str): The URL of the web page.
+    content (bytes): The content of the web page.
+    headers (Mapping): The response headers.
+    """
+    validators = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+    if not any(validators.values()):
+        return
+    content_path, validators_path = _cache_paths(url)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Remove the old validators first, so that they can never be paired with a partially written page
+        try:
+            os.remove(validators_path)
+        except FileNotFoundError:
+            pass
+        _replace_file(content_path, content)
+        # The validators are written last, so that a page is only used once it was written completely
+        _replace_file(validators_path, json.dumps(validators).encode('utf-8'))
+    except OSError as e:
+        print(f"Failed to cache {url}: {e}")
+
+
+def _replace_file(path, data):
+    """
+    Atomically replaces the content of a file by writing to a temporary file first.
+
+    Parameters:
+    path (str): The path of the file.
+    data (bytes): The new content of the file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
+@functools.lru_cache(maxsize=64)
 def fetch_webpage(url):
     """
     Fetches the HTML content of a web page given a URL.
+    Pages are cached in memory and on disk; a cached page is only used if the server confirms it is unchanged.
 
     Parameters:
     url (str): The URL of the web page to fetch.
 
     Returns:
-    str: The HTML content of the web page.
+    bytes: The raw HTML content of the web page, decoded only by the parser.
     """
-    response = urllib.request.urlopen(url)
-    html = response.read()
-    return html.decode('utf-8')
+    cached, headers = _read_cache(url)
+    response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304 and cached is not None:
+        return cached
+    response.raise_for_status()
+    _write_cache(url, response.content, response.headers)
+    return response.content
 
 
-def extract_section(html, tag, class_name=None):
+async def _fetch(session, semaphore, url):
     """
-    Extracts sections from the HTML content based on the specified tag and class name.
+    Fetches the HTML content of a web page asynchronously.
+    Uses the same disk cache as fetch_webpage.
 
     Parameters:
-    html (str): The HTML content of the web page.
-    tag (str): The HTML tag to search for.
-    class_name (str, optional): The class name of the tag to search for. Defaults to None.
+    session (aiohttp.ClientSession): The session used for the request.
+    semaphore (asyncio.Semaphore): Limits the number of concurrent requests.
+    url (str): The URL of the web page to fetch.
 
     Returns:
-    list: A list of extracted sections as strings.
+    bytes: The raw HTML content of the web page, decoded only by the parser.
     """
-    soup = BeautifulSoup(html, 'html.parser')
-    if class_name:
-        sections = soup.find_all(tag, class_=class_name)
-    else:
-        sections = soup.find_all(tag)
-    return [str(section) for section in sections]
+    # The disk cache is read and written in the default executor to keep the event loop responsive
+    loop = asyncio.get_running_loop()
+    cached, headers = await loop.run_in_executor(None, _read_cache, url)
+    async with semaphore:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                return cached
+            response.raise_for_status()
+            html = await response.read()
+    await loop.run_in_executor(None, _write_cache, url, html, response.headers)
+    return html
+
+
+# lxml parsers must not be shared between threads, so each thread reuses its own parser
+_parsers = threading.local()
+
+
+def _parser():
+    """
+    Returns the HTML parser of the current thread, creating it on first use.
+    The parser drops comments and does not collect IDs, which are never used.
+    Raw bytes are decoded as UTF-8 while parsing, like all pages of projekt-gutenberg.org.
 
+    Returns:
+    lxml.html.HTMLParser: The HTML parser.
+    """
+    if not hasattr(_parsers, 'parser'):
+        _parsers.parser = lxml.html.HTMLParser(
+            encoding='utf-8', remove_blank_text=False, remove_comments=True, collect_ids=False)
+    return _parsers.parser
 
-def extract_content_by_class(html_content, class_name):
+
+def _tree(html):
     """
-    Extracts the text content from HTML tags of a specific class.
+    Parses HTML content into an lxml element tree.
 
     Parameters:
-    html_content (str): The HTML content as a string.
+    html (str or bytes): The HTML content to parse.
+
+    Returns:
+    lxml.html.HtmlElement: The root <html> element of the parsed document.
+    """
+    if not html.strip():
+        # lxml refuses to parse empty documents
+        html = '<html><body></body></html>'
+    return lxml.html.document_fromstring(html, parser=_parser())
+
+
+# Stylesheet links, matching "stylesheet" as one word of the rel attribute like browsers do
+_STYLESHEET_XPATH = lxml.etree.XPath(".//link[contains(concat(' ', normalize-space(@rel), ' '), ' stylesheet ')]")
+
+
+def _fragment(html):
+    """
+    Parses an HTML fragment, such as the content of a chapter, in the context of a <body> element.
+    Unlike _tree, this keeps leading <script>, <style>, <link> or <meta> tags in place
+    instead of moving them to the document head.
+
+    Parameters:
+    html (str): The HTML fragment to parse.
+
+    Returns:
+    lxml.html.HtmlElement: The <body> element holding the parsed fragment.
+    """
+    return lxml.html.fragment_fromstring(html, create_parent='body', parser=_parser())
+
+
+@functools.lru_cache(maxsize=None)
+def _class_xpath(tag, first):
+    """
+    Compiles the XPath expression for finding elements by class once per tag and search mode.
+    The class name is passed to the compiled expression as the variable $cls, surrounded by spaces.
+
+    Parameters:
+    tag (str): The tag name of the elements to search for.
+    first (bool): If True, the expression only selects the first matching element.
+
+    Returns:
+    lxml.etree.XPath: The compiled XPath expression.
+    """
+    query = f".//{tag}[contains(concat(' ', normalize-space(@class), ' '), $cls)]"
+    if first:
+        query = f"({query})[1]"
+    return lxml.etree.XPath(query)
+
+
+def _find_by_class(tree, class_name, tag='*', first=False):
+    """
+    Finds all elements of a tree that have a specific class, using lxml's XPath engine.
+
+    Parameters:
+    tree (lxml.html.HtmlElement): The element to search in; only its descendants are searched.
     class_name (str): The class name to search for.
+    tag (str, optional): The tag name of the elements to search for. Defaults to all tags.
+    first (bool, optional): If True, the search stops at the first matching element. Defaults to False.
+
+    Returns:
+    list: A list of matching elements in document order.
+    """
+    return _class_xpath(tag, first)(tree, cls=f' {class_name} ')
+
+
+def _inner_html(element):
+    """
+    Serializes the content of an element without the element's own tags.
+
+    Parameters:
+    element (lxml.html.HtmlElement): The element to serialize.
 
     Returns:
-    list: A list of strings containing the text content of each tag with the specified class.
+    str: The HTML content of the element.
+    """
+    content = [escape(element.text or '', quote=False)]
+    content += [lxml.html.tostring(child, encoding='unicode') for child in element]
+    return ''.join(content)
+
+
+def _text(element):
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-    content_list = [element.get_text(strip=True) for element in soup.find_all(class_=class_name)]
-    return content_list
+    Returns the text content of an element with all whitespace collapsed to single spaces,
+    so that e.g. titles containing line breaks stay on one line.
+
+    Parameters:
+    element (lxml.html.HtmlElement): The element to get the text of.
+
+    Returns:
+    str: The normalized text content of the element.
+    """
+    return ' '.join(element.text_content().split())
+
+
+def _first_text_by_class(element, class_name):
+    """
+    Finds the text content of the first tag of a specific class.
+
+    Parameters:
+    element (lxml.html.HtmlElement): The element to search in.
+    class_name (str): The class name to search for.
+
+    Returns:
+    str: The text content of the first tag with the specified class, or None if there is no such tag.
+    """
+    elements = _find_by_class(element, class_name, first=True)
+    return _text(elements[0]) if elements else None
+
+
+def _resource_links(element):
+    """
+    Finds all links to resources (images, stylesheets, scripts) which have to be downloaded with a page.
+
+    Parameters:
+    element (lxml.html.HtmlElement): The element to search in.
+
+    Returns:
+    list: A list of (element, attribute) tuples for every non-empty resource link.
+    """
+    links = []
+    # Links of <img> tags
+    links += [(img, 'src') for img in element.iter('img')]
+    # Links of <link> tags (e.g., stylesheets)
+    links += [(link, 'href') for link in _STYLESHEET_XPATH(element)]
+    # Links of <script> tags
+    links += [(script, 'src') for script in element.iter('script')]
+    return [(tag, attribute) for tag, attribute in links if tag.get(attribute)]
 
 
 def extract_links(anchor_tags):
     """
-    Extracts the href attribute from a list of <a> tag strings.
+    Extracts the href attribute from a list of <a> elements.
 
     Parameters:
-    anchor_tags (list): A list of strings, each containing an <a> tag.
+    anchor_tags (list): A list of parsed <a> elements.
 
     Returns:
     list: A list of href attribute values (URLs).
     """
-    links = []
-    for tag in anchor_tags:
-        soup = BeautifulSoup(tag, 'html.parser')
-        a_tag = soup.find('a', href=True)
-        if a_tag:
-            links.append(a_tag['href'])
-    return links
+    return [a.get('href') for a in anchor_tags if a.get('href')]
 
 
 def extract_links_and_text(anchor_tags):
     """
-    Extracts URLs and link text from a list of <a> tag strings.
+    Extracts URLs and link text from a list of <a> elements.
 
     Parameters:
-    anchor_tags (list): A list of strings, each containing an <a> tag.
+    anchor_tags (list): A list of parsed <a> elements.
 
     Returns:
     dict: A dictionary where keys are URLs from href attributes and values are the link text.
     """
-    links_dict = {}
-    for tag in anchor_tags:
-        soup = BeautifulSoup(tag, 'html.parser')
-        a_tag = soup.find('a', href=True)
-        if a_tag:
-            href = a_tag['href']
-            text = a_tag.get_text(strip=True)
-            links_dict[href] = text
-    return links_dict
+    return {a.get('href'): (a.text_content() or '').strip() for a in anchor_tags if a.get('href')}
 
 
-def extract_stylesheet_links(html):
+def extract_stylesheet_links(tree):
     """
     Extracts all stylesheet (CSS) links from an HTML page.
 
     Parameters:
-    html (str): The HTML content of the web page.
+    tree (lxml.html.HtmlElement): The parsed HTML document.
 
     Returns:
     list: A list of URLs pointing to the CSS stylesheets.
     """
-    soup = BeautifulSoup(html, 'html.parser')
     stylesheet_links = []
-    for link_tag in soup.find_all('link', rel='stylesheet'):
+    for link_tag in _STYLESHEET_XPATH(tree):
         href = link_tag.get('href')
         if href:
             stylesheet_links.append(href)
     return stylesheet_links
 
 
-def get_chapter_urls(url):
+def chapter_urls_from_tree(tree, url):
     """
-    Extracts all chapter URLs and the chapter names from the index page.
+    Extracts all chapter URLs and the chapter names from the already parsed index page.
+    The chapters are the links in the last <ul> list of the page.
 
     Parameters:
-    url (str): The main URL of the book (base URL or URL of any chapter or of index)
+    tree (lxml.html.HtmlElement): The parsed index page.
+    url (str): The base URL of the book.
 
     Returns:
     dict: a dictionary with chapter URLs as keys and chapter names as values
     """
-    if not url.endswith('/'):
-        url = url[:url.rfind('/') + 1]
-    index_page = fetch_webpage(url)
-    section = extract_section(index_page, "ul").pop()
-    anchors = extract_section(section, "a")
+    anchors = tree.xpath('(//ul)[last()]//a[@href]')
     links = extract_links_and_text(anchors)
-    links = {f"{url}{key}": value for key, value in links.items()}
-    return links
+    return {urljoin(url, key): value for key, value in links.items()}
 
 
-def remove_leading_to_class(html_content, target_class):
+def remove_leading_to_class(tree, target_class):
     """
-    Removes the leading part of an HTML string up to and including a tag with a specific class.
+    Removes everything in front of and including the first tag with a specific class.
 
     Parameters:
-    html_content (str): The HTML content as a string.
+    tree (lxml.html.HtmlElement): The parsed HTML document, modified in place.
     target_class (str): The class name to search for.
-
-    Returns:
-    str: The modified HTML content with the leading part removed.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-    target_element = soup.find(class_=target_class)
+    target_elements = _find_by_class(tree, target_class, first=True)
 
-    if target_element:
-        # Find the position of the target element in the original HTML
-        target_position = html_content.find(str(target_element))
-        if target_position != -1:
-            # Return the HTML content starting after the target element
-            return html_content[target_position + len(str(target_element)):]
+    if target_elements:
+        # Remove the target element and all content before it
+        remove_until(target_elements[0])
 
-    # If the target element is not found, return the original HTML content
-    return html_content
 
-
-def remove_rightmost_div_by_class(html_content, target_class):
+def remove_rightmost_div_by_class(tree, target_class):
     """
-    Removes the rightmost part of an HTML string starting with a <div> tag of a specific class.
+    Removes the last <div> tag of a specific class and everything following it.
 
     Parameters:
-    html_content (str): The HTML content as a string.
+    tree (lxml.html.HtmlElement): The parsed HTML document, modified in place.
     target_class (str): The class name to search for in <div> tags.
-
-    Returns:
-    str: The modified HTML content with the rightmost part removed.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-    div_tags = soup.find_all('div', class_=target_class)
+    div_tags = _find_by_class(tree, target_class, 'div')
 
     if div_tags:
-        # Find the last occurrence of the target <div> tag
-        last_div = div_tags[-1]
-        # Find the position of the last <div> tag in the original HTML
-        div_position = html_content.rfind(str(last_div))
-        if div_position != -1:
-            # Return the HTML content up to the start of the last <div> tag
-            return html_content[:div_position]
+        # Remove the last occurrence of the target <div> tag and all content after it
+        remove_from(div_tags[-1])
 
-    # If no target <div> tag is found, return the original HTML content
-    return html_content
 
+def remove_until(element):
+    """
+    Removes an element and all content preceding it in document order.
+    The ancestors of the element and the text following the element are kept.
 
-def remove_divs_by_class(html_content, target_class):
+    Parameters:
+    element (lxml.html.HtmlElement): The last element to remove.
     """
-    Removes all <div> sections of a specific class from an HTML string.
+    for node in [element, *element.iterancestors()]:
+        parent = node.getparent()
+        if parent is None:
+            break
+        for sibling in list(node.itersiblings(preceding=True)):
+            parent.remove(sibling)
+        parent.text = None
+    # drop_tree() keeps the text following the element
+    element.drop_tree()
+
+
+def remove_from(element):
+    """
+    Removes an element and all content following it in document order.
+    The ancestors of the element are kept.
 
     Parameters:
-    html_content (str): The HTML content as a string.
-    target_class (str): The class name of the <div> tags to remove.
+    element (lxml.html.HtmlElement): The first element to remove.
+    """
+    parent = element.getparent()
+    for node in [element, *element.iterancestors()]:
+        if node.getparent() is None:
+            break
+        for sibling in list(node.itersiblings()):
+            node.getparent().remove(sibling)
+        node.tail = None
+    parent.remove(element)
 
-    Returns:
-    str: The modified HTML content with the specified <div> sections removed.
+
+def remove_divs_by_class(tree, target_class):
+    """
+    Removes all <div> sections of a specific class.
+
+    Parameters:
+    tree (lxml.html.HtmlElement): The parsed HTML document, modified in place.
+    target_class (str): The class name of the <div> tags to remove.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
+    # Find and remove all <div> tags with the specified class, keeping the text following them
+    for div in _find_by_class(tree, target_class, 'div'):
+        div.drop_tree()
 
-    # Find and remove all <div> tags with the specified class
-    for div in soup.find_all('div', class_=target_class):
-        div.decompose()
 
-    return str(soup)
+# Heading levels are upgraded by one to facilitate creating of the TOC in Calibre
+HEADING_UPGRADES = {'h2': 'h1', 'h3': 'h2', 'h4': 'h3'}
 
 
-def modify_headline_classes(html_content):
+def fix_headings(tree):
     """
-    Adds the class "chapter" to all <h1>, <h2> and <h3> tags unless they already have a class "title" or "subtitle" or "author".
+    Upgrades <h2>, <h3> and <h4> tags by one level and adds the class "chapter" to all resulting <h1>, <h2> and <h3>
+    tags unless they already have a class "title" or "subtitle" or "author".
     For modified tags, all other classes except "chapter" are removed.
+    Both changes are done in a single pass over the headings.
 
     Parameters:
-    html_content (str): The HTML content as a string.
-
-    Returns:
-    str: The modified HTML content with updated classes for <h1> and <h2> tags.
+    tree (lxml.html.HtmlElement): The parsed HTML document, modified in place.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-
-    # Iterate over all <h1>, <h2> and <h3> tags
-    for tag in soup.find_all(['h1', 'h2', 'h3', 'h4']):
-        classes = tag.get('class', [])
+    for tag in list(tree.iter('h1', 'h2', 'h3', 'h4')):
+        tag.tag = HEADING_UPGRADES.get(tag.tag, tag.tag)
+        classes = tag.get('class', '').split()
         # Check if the tag has "title" or "author" class
         if 'title' not in classes and 'author' not in classes and 'subtitle' not in classes:
             # Set the class to "chapter", removing any existing classes
-            tag['class'] = ['chapter']
+            tag.set('class', 'chapter')
 
-    return str(soup)
-
-
-def extract_meta_tags(html_string):
-    # Parse the HTML string using BeautifulSoup
-    soup = BeautifulSoup(html_string, 'html.parser')
 
+def extract_meta_tags(tree):
     # Initialize an empty dictionary to store meta tags
     meta_tags = {}
 
     # Find all meta tags in the HTML
-    for meta in soup.find_all('meta'):
+    for meta in tree.iter('meta'):
         # Get the 'name' or 'property' attribute as the key
         key = meta.get('name') or meta.get('property')
         # Get the 'content' attribute as the value
@@ -253,120 +505,113 @@ def extract_meta_tags(html_string):
     return meta_tags
 
 
-def get_prosa(url):
+# A processed chapter: its HTML content, the URLs of the resources it links to, and the text
+# of its first tags of class "author" and "title" (None if there is no such tag)
+Chapter = collections.namedtuple('Chapter', ['html', 'resources', 'author', 'title'])
+
+
+def extract_prosa(html, url):
     """
-    Extracts the chapter content without header, navigation bar, and footer
+    Strips header, navigation bar, and footer from the HTML of a chapter page
+    and converts all relative links to absolute links.
+    Everything the book needs from the chapter is taken from the same parsed tree,
+    so the chapter does not have to be parsed again before it is written.
 
     Parameters:
-    url(str): The URL of the chapter
+    html (bytes): The raw HTML content of the chapter page
+    url (str): The URL of the chapter, used as base for relative links
 
     Returns:
-    str: The HTML content for the book chapter
+    Chapter: The HTML content for the book chapter, its resource URLs, and its author and title
     """
-    page = fetch_webpage(url)
+    tree = _tree(html)
     # The prosa starts after the tag of class "anzeige-chap"
-    page = remove_leading_to_class(page, "anzeige-chap")
+    remove_leading_to_class(tree, "anzeige-chap")
     # Remove everything after and including the bottom navigation bar
-    page = remove_rightmost_div_by_class(page, "bottomnavi-gb")
+    remove_rightmost_div_by_class(tree, "bottomnavi-gb")
     # Remove and print ads
-    page = remove_divs_by_class(page, "anzeige-print")
-    # The prosa ends at the last <hr> tag
-    last_hr_index = page.rfind('<hr')
-    if last_hr_index != -1:
-        page = page[:last_hr_index]
-    # Upgrade heading levels to facilitate creating of TOC in Calibre
-    page = modify_headline_classes(page)
-    return page
-
-
-def get_book_content(url):
+    remove_divs_by_class(tree, "anzeige-print")
+    # The prosa ends at the last <hr> tag, which is removed together with everything after it
+    for last_hr in tree.xpath('(//hr)[last()]'):
+        remove_from(last_hr)
+    # Upgrade heading levels and classes to facilitate creating of TOC in Calibre
+    fix_headings(tree)
+    # Links must not depend on the location of the chapter page anymore
+    tree.make_links_absolute(url, resolve_base_href=True, handle_failures='ignore')
+    body = tree.body
+    resources = [tag.get(attribute) for tag, attribute in _resource_links(body)]
+    # Serialize only the chapter content, not the surrounding document
+    return Chapter(_inner_html(body), resources,
+                   _first_text_by_class(body, "author"), _first_text_by_class(body, "title"))
+
+
+async def _get_prosa(session, semaphore, url):
     """
-    Get the pure book content (just the prosa) of a book.
+    Downloads a chapter asynchronously and extracts its content in a worker thread,
+    so that parsing overlaps with the downloads of the other chapters.
 
     Parameters:
-    url (str): The base URL of the book.
+    session (aiohttp.ClientSession): The session used for the request.
+    semaphore (asyncio.Semaphore): Limits the number of concurrent requests.
+    url (str): The URL of the chapter.
 
     Returns:
-    str: The concatenated prosa of all chapters.
+    Chapter: The processed chapter
     """
-    chapter_urls = get_chapter_urls(url)
-    book = [get_prosa(x) for x in chapter_urls.keys()]
-    book = "\n".join(book)
-    return book
-
+    html = await _fetch(session, semaphore, url)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, extract_prosa, html, url)
 
-def generate_html(meta_tags, main_content, stylesheet_urls, title):
-    # Start the HTML document
-    html = ['<!DOCTYPE html>', '<html>', '<head>']
 
-    # Add the title
-    html.append(f'<title>{title}</title>')
-
-    # Add meta tags
-    for name, content in meta_tags.items():
-        html.append(f'<meta name="{name}" content="{content}">')
-
-    # Add stylesheet links
-    for url in stylesheet_urls:
-        html.append(f'<link rel="stylesheet" type="text/css" href="{url}">')
-
-    # Close the head section and start the body section
-    html.append('</head>')
-    html.append('<body>')
-
-    # Add the main content
-    html.append(main_content)
-
-    # Close the body and html tags
-    html.append('</body>')
-    html.append('</html>')
-
-    # Join all parts into a single string
-    return '\n'.join(html)
-
-
-def convert_relative_to_absolute(html_content, base_url):
+async def get_book_content(chapter_urls):
     """
-    Converts all relative links in an HTML page to absolute links using the provided base URL.
+    Get the pure book content (just the prosa) of a book.
+    All chapters are downloaded concurrently.
 
     Parameters:
-    html_content (str): The HTML content as a string.
-    base_url (str): The base URL to use for converting relative links to absolute links.
+    chapter_urls (iterable): The URLs of all chapters of the book, in reading order.
 
     Returns:
-    str: The modified HTML content with absolute links.
+    list: The processed chapters (see Chapter), in reading order.
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-
-    if not base_url.endswith('/'):
-        base_url = base_url[:base_url.rfind('/') + 1]
+    semaphore = asyncio.Semaphore(CONCURRENT_DOWNLOADS)
+    # Like the timeout of requests, the timeout applies to connecting and to each read, not to the whole download
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        book = await asyncio.gather(*[_get_prosa(session, semaphore, x) for x in chapter_urls])
+    return book
 
-    # Convert relative links in <a> tags
-    for a_tag in soup.find_all('a', href=True):
-        a_tag['href'] = urljoin(base_url, a_tag['href'])
 
-    # Convert relative links in <img> tags
-    for img_tag in soup.find_all('img', src=True):
-        img_tag['src'] = urljoin(base_url, img_tag['src'])
+def generate_html(meta_tags, stylesheet_urls, title):
+    # Meta tags and stylesheet links, with all values escaped
+    meta_html = ''.join(f'<meta name="{escape(name)}" content="{escape(content)}">\n'
+                        for name, content in meta_tags.items())
+    css_html = ''.join(f'<link rel="stylesheet" type="text/css" href="{escape(url)}">\n'
+                       for url in stylesheet_urls)
 
-    # Convert relative links in <link> tags
-    for link_tag in soup.find_all('link', href=True):
-        link_tag['href'] = urljoin(base_url, link_tag['href'])
+    # The body section is left empty, it is filled chapter by chapter
+    return (f'<!DOCTYPE html>\n<html>\n<head>\n<title>{escape(title)}</title>\n{meta_html}{css_html}</head>\n'
+            f'<body>\n</body>\n</html>')
 
-    # Convert relative links in <script> tags
-    for script_tag in soup.find_all('script', src=True):
-        script_tag['src'] = urljoin(base_url, script_tag['src'])
 
-    return str(soup)
+def save_html_with_resources(html_string, chapters, save_dir, html_filename):
+    """
+    Saves an HTML page with all chapters of a book in its body and downloads all resources
+    (images, stylesheets, scripts) to a subdirectory, updating the links to the local copies.
+    The page is streamed to disk chapter by chapter, so only one chapter is parsed at a time.
 
+    Parameters:
+    html_string (str): The HTML page with an empty body.
+    chapters (list): The processed chapters (see Chapter), in reading order.
+    save_dir (str): The directory to save the HTML file in.
+    html_filename (str): The name of the HTML file.
 
-def save_html_with_resources(html_string, save_dir, html_filename):
+    Returns:
+    str: The path of the saved HTML file.
+    """
     # Create the save directory if it doesn't exist
     os.makedirs(save_dir, exist_ok=True)
 
-    # Parse the HTML content
-    soup = BeautifulSoup(html_string, 'html.parser')
-
     # Create a subdirectory for resources
     if html_filename.endswith('.html'):
         # Remove the '.html' extension and append '_files'
@@ -377,45 +622,83 @@ def save_html_with_resources(html_string, save_dir, html_filename):
     resources_dir = os.path.join(save_dir, resources_dir)
     os.makedirs(resources_dir, exist_ok=True)
 
-    # Define a function to download and replace links
-    def download_and_replace(tag, attribute):
-        url = tag.get(attribute)
-        if url:
-            # Resolve the full URL
-            full_url = urljoin(html_filename, url)
-            # Parse the URL to get the filename
-            parsed_url = urlparse(full_url)
-            filename = os.path.basename(parsed_url.path)
-            local_path = os.path.join(resources_dir, filename)
+    # Pending or finished download of every distinct resource, shared by all chapters
+    downloads = {}
 
-            # Download the resource
-            try:
-                response = requests.get(full_url)
+    # Define a function to download a single resource, run in a worker thread
+    def download(full_url, local_path):
+        try:
+            # Stream the resource to the file instead of buffering it in memory
+            with SESSION.get(full_url, timeout=REQUEST_TIMEOUT, stream=True) as response:
                 response.raise_for_status()
                 with open(local_path, 'wb') as file:
-                    file.write(response.content)
-
-                # Update the tag's attribute to point to the local resource
-                tag[attribute] = os.path.relpath(local_path, save_dir)
-            except requests.RequestException as e:
-                print(f"Failed to download {full_url}: {e}")
-
-    # Download and replace links for <img> tags
-    for img in soup.find_all('img'):
-        download_and_replace(img, 'src')
-
-    # Download and replace links for <link> tags (e.g., stylesheets)
-    for link in soup.find_all('link', rel='stylesheet'):
-        download_and_replace(link, 'href')
-
-    # Download and replace links for <script> tags
-    for script in soup.find_all('script'):
-        download_and_replace(script, 'src')
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+            return True
+        except requests.RequestException as e:
+            print(f"Failed to download {full_url}: {e}")
+            return False
+
+    # Local file of every distinct resource; different URLs never share a file
+    local_paths = {}
+    used_paths = set()
+
+    # Define a function to choose the local file of a resource, numbering files whose names are already taken
+    def local_path_for(key):
+        if key not in local_paths:
+            # Parse the URL to get the filename
+            parsed_url = urlparse(key)
+            filename = os.path.basename(parsed_url.path)
+            stem, extension = os.path.splitext(filename)
+            local_path = os.path.join(resources_dir, filename)
+            number = 1
+            while local_path in used_paths:
+                local_path = os.path.join(resources_dir, f"{stem}-{number}{extension}")
+                number += 1
+            local_paths[key] = local_path
+            used_paths.add(local_path)
+        return local_paths[key]
+
+    # Define a function to identify a resource; lxml percent-escapes links when serializing,
+    # so the links read back from a written chapter may be escaped while the collected ones are not
+    def resource_key(url):
+        return unquote(urljoin(html_filename, url))
+
+    # Define a function to start the download of every distinct resource once
+    def submit(urls, executor):
+        for url in urls:
+            key = resource_key(url)
+            if key not in downloads:
+                downloads[key] = executor.submit(download, urljoin(html_filename, url), local_path_for(key))
+
+    # Define a function to wait for the downloads of a tree and update its links to point to the local resources;
+    # the tree is only touched here, because lxml trees must not be modified from several threads
+    def replace(tree):
+        for tag, attribute in _resource_links(tree):
+            key = resource_key(tag.get(attribute))
+            if downloads[key].result():
+                tag.set(attribute, os.path.relpath(local_path_for(key), save_dir))
 
-    # Save the modified HTML to a file
     html_path = os.path.join(save_dir, html_filename)
-    with open(html_path, 'w', encoding='utf-8') as file:
-        file.write(str(soup))
+    page = _tree(html_string)
+    with ThreadPoolExecutor(max_workers=RESOURCE_DOWNLOAD_WORKERS) as executor, \
+            open(html_path, 'w', encoding='utf-8') as file:
+        submit([tag.get(attribute) for tag, attribute in _resource_links(page)], executor)
+        # Start the downloads of all chapters before waiting for any of them
+        for chapter in chapters:
+            submit(chapter.resources, executor)
+
+        replace(page)
+        file.write('<!DOCTYPE html>\n<html>\n')
+        file.write(lxml.html.tostring(page.head, encoding='unicode', with_tail=False))
+        file.write('\n<body>\n')
+        # Write the chapters one by one, so that only one chapter is held as a tree at a time
+        for chapter in chapters:
+            body = _fragment(chapter.html)
+            replace(body)
+            file.write(_inner_html(body))
+            file.write('\n')
+        file.write('</body>\n</html>\n')
 
     return html_path
 
@@ -429,25 +712,23 @@ def write_book(base_url):
     """
     if not base_url.endswith('/'):
         base_url = base_url[:base_url.rfind('/') + 1]
-    book_content = get_book_content(base_url)
-    meta_tags = extract_meta_tags(fetch_webpage(base_url))
+    # The index page is fetched and parsed only once and used for chapters, meta tags and stylesheets
+    index_tree = _tree(fetch_webpage(base_url))
+    chapter_urls = chapter_urls_from_tree(index_tree, base_url)
+    chapters = asyncio.run(get_book_content(chapter_urls))
+    meta_tags = extract_meta_tags(index_tree)
     # Get the author, either from a tag with class "author" or from the meta tags
-    author = extract_content_by_class(book_content, "author")
-    if author:
-        author = author[0]
-    else:
+    author = next((chapter.author for chapter in chapters if chapter.author is not None), None)
+    if author is None:
         author = meta_tags.get("author", "Unknown")
     # Get the title, either from a tag with class "title" or from the meta tags
-    title = extract_content_by_class(book_content, "title")
-    if title:
-        title = title[0]
-    else:
+    title = next((chapter.title for chapter in chapters if chapter.title is not None), None)
+    if title is None:
         title = meta_tags.get("title", "Unknown")
-    stylesheet_urls = extract_stylesheet_links(fetch_webpage(base_url))
-    full_page = generate_html(meta_tags, book_content, stylesheet_urls, title)
-    full_page = convert_relative_to_absolute(full_page, base_url)
+    stylesheet_urls = [urljoin(base_url, url) for url in extract_stylesheet_links(index_tree)]
+    page = generate_html(meta_tags, stylesheet_urls, title)
     file_name = f"{author} - {title}.html"
-    save_html_with_resources(full_page, ".", file_name)
+    save_html_with_resources(page, chapters, ".", file_name)
 
 
 def main():